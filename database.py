@@ -1,8 +1,14 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
-from models import User, Event, Attendance, UserStatus, ParticipantStatus, EventStatus
+from models import User, Event, Attendance, UserStatus, ParticipantStatus, EventStatus, now_ms
 from config import config
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from cachetools import TTLCache
+import threading
+import time
+import uuid
 
 # 初始化 Firestore
 # 注意：在 Cloud Run 上不需要 creds，會自動抓取 Service Account
@@ -15,7 +21,161 @@ if not firebase_admin._apps:
 
 db = firestore.client()
 
+class InvalidCursorError(Exception):
+    """分頁游標指向不存在的文件"""
+
+# 統計結果與成員列表的快取秒數 (僅限本 process，多個 instance 之間不共用)
+STATS_CACHE_TTL = 30
+MEMBERS_CACHE_TTL = 30
+# 成員彙總快照保留秒數 (超過 MEMBERS_CACHE_TTL 後只要 version 沒變就繼續沿用)
+MEMBERS_SNAPSHOT_TTL = 300
+# 記住最近互動過的使用者數量上限 (LRU)
+KNOWN_USERS_MAX = 4096
+# Firestore 單一 WriteBatch 最多 500 筆操作
+BATCH_LIMIT = 500
+
+# 只讀取實際用到的欄位 (projection)，減少傳輸量
+MEMBER_FIELDS = ['line_id', 'display_name', 'club_name', 'status', 'sort_order']
+# family_adults / family_kids 只供舊版報名紀錄補算人數
+STATS_PARTICIPANT_FIELDS = ['status', 'guests', 'guest_count', 'total_adults', 'total_kids',
+                            'family_adults', 'family_kids']
+
+# 統計名單中成員身分的編碼 (INACTIVE 不列入名單)
+ROSTER_ACTIVE = 0
+ROSTER_LEAVE = 1
+_ROSTER_CODES = {UserStatus.ACTIVE.value: ROSTER_ACTIVE, UserStatus.LEAVE.value: ROSTER_LEAVE}
+
+# 報名狀態編碼，無紀錄或非預期的狀態一律視為 PARTICIPANT_NONE (Rule 5)
+PARTICIPANT_GOING = 0
+PARTICIPANT_NOT_GOING = 1
+PARTICIPANT_NONE = 2
+_PARTICIPANT_CODES = {
+    ParticipantStatus.GOING.value: PARTICIPANT_GOING,
+    ParticipantStatus.NOT_GOING.value: PARTICIPANT_NOT_GOING,
+}
+
+# 統計分類規則矩陣 _RULE_MATRIX[成員身分編碼][報名狀態編碼] -> 分類
+# Rule 1: 確定出席 (不管身分，只要報名 +1 就算)
+# Rule 2: 長期請假 (身分為 LEAVE 且 沒報名出席)
+#         注意：即使他在 Flex 按 -1，依然歸類在此，不算 "不克出席"
+# Rule 3: 不克出席 (身分 ACTIVE 且 報名 -1)
+# Rule 4: 尚未回覆 (身分 ACTIVE 且 無紀錄)
+_RULE_MATRIX = [
+    # GOING    NOT_GOING     NONE
+    ["going", "not_going", "no_response"],  # ROSTER_ACTIVE
+    ["going", "leave",     "leave"],        # ROSTER_LEAVE
+]
+
+# 成員彙總快照 {("members", version): aggregate}，所有 API 共用
+# cachetools 不是 thread-safe，存取時需持有 _members_lock
+_members_snapshots = TTLCache(maxsize=4, ttl=MEMBERS_SNAPSHOT_TTL)
+_members_lock = threading.Lock()
+
+# 用來平行發出彼此獨立的 Firestore 查詢 (client 為 thread-safe，等待 RPC 時會釋放 GIL)
+_pool = ThreadPoolExecutor(max_workers=8)
+
 class Database:
+    def __init__(self):
+        # 統計快取: {event_id: (version, cached_at, stats)}
+        self._stats_cache = {}
+        # 每個活動的寫入版本，報名有異動就 +1 讓快取失效
+        self._event_version = {}
+        # 最近一次確認的成員彙總版本: (checked_at, snapshot key)
+        self._members_checked = None
+        # 已確認存在的使用者 {line_id: display_name}，命中時不必先讀取 users 文件
+        self._known_users = OrderedDict()
+
+    # --- 成員彙總文件 (aggregates/members) ---
+    # 將所有成員依 sort_order 排好存成單一文件，讀取時 1 次 read 取代整個 users 集合
+    # members: 完整成員列表 (管理列表用)
+    # roster: 統計用名單 (僅 ACTIVE / LEAVE)，以平行陣列存放 line_ids / names / status_codes
+
+    @staticmethod
+    def _build_roster(members: list):
+        """由成員列表產生統計用名單，顯示名稱優先用社團暱稱"""
+        roster = {"line_ids": [], "names": [], "status_codes": []}
+        for m in members:
+            code = _ROSTER_CODES.get(m.get('status'))
+            if code is None:
+                continue
+            roster["line_ids"].append(m['line_id'])
+            roster["names"].append(m.get('club_name') or m.get('display_name'))
+            roster["status_codes"].append(code)
+        return roster
+
+    @staticmethod
+    def _touches_members(fields):
+        """寫入的欄位是否包含成員彙總用到的欄位 (MEMBER_FIELDS)，只改 is_admin 等欄位時不必重建"""
+        return any(f in MEMBER_FIELDS for f in fields)
+
+    def _rebuild_members_aggregate(self):
+        """重新產生成員彙總文件 (任何成員資料異動後呼叫)"""
+        aggregate_ref = db.collection('aggregates').document('members')
+        query = db.collection('users')\
+            .select(MEMBER_FIELDS)\
+            .order_by('sort_order')
+
+        # 讀取 users 與寫入彙總在同一個交易內：重建期間若有成員寫入會被擋下或重試，
+        # 避免讀到舊資料的重建較晚寫入，以較新的 version 蓋掉正確的名單
+        @firestore.transactional
+        def rebuild(transaction):
+            members = [doc.to_dict() for doc in transaction.get(query)]
+            aggregate = {
+                "members": members,
+                "roster": self._build_roster(members),
+                # version 每次重建都唯一 (同一毫秒的重建也不會撞號)，供快取比對
+                "version": uuid.uuid4().hex,
+                "updated_at_ms": now_ms()
+            }
+            transaction.set(aggregate_ref, aggregate)
+            return aggregate
+
+        aggregate = rebuild(db.transaction())
+        # 順便更新本機快取
+        self._remember_members_snapshot(aggregate)
+        return aggregate
+
+    def _remember_members_snapshot(self, aggregate: dict):
+        """記錄新版本的成員彙總快照，名單有變所以同時讓所有統計快取失效"""
+        key = ("members", aggregate.get('version'))
+        with _members_lock:
+            _members_snapshots[key] = aggregate
+        self._members_checked = (time.monotonic(), key)
+        self._stats_cache.clear()
+
+    def _get_members_aggregate(self):
+        """
+        讀取成員彙總文件 (有快取)，尚未建立時 (第一次部署) 直接重建
+        MEMBERS_CACHE_TTL 秒內直接使用本機快照；之後只讀取 version 欄位，
+        version 沒變 (其他 instance 也沒有寫入) 就沿用快照，不必重新下載整份名單
+        """
+        checked = self._members_checked
+        if checked and time.monotonic() - checked[0] < MEMBERS_CACHE_TTL:
+            with _members_lock:
+                aggregate = _members_snapshots.get(checked[1])
+            if aggregate is not None:
+                return aggregate
+
+        ref = db.collection('aggregates').document('members')
+        head = ref.get(field_paths=['version'])
+        if not head.exists:
+            return self._rebuild_members_aggregate()
+
+        key = ("members", head.to_dict().get('version'))
+        with _members_lock:
+            aggregate = _members_snapshots.get(key)
+        if aggregate is not None:
+            self._members_checked = (time.monotonic(), key)
+            return aggregate
+
+        aggregate = ref.get().to_dict()
+        aggregate.setdefault('members', [])
+        if 'roster' not in aggregate:
+            # 舊版彙總文件沒有 roster，在本機補算
+            aggregate['roster'] = self._build_roster(aggregate['members'])
+        self._remember_members_snapshot(aggregate)
+        return aggregate
+
     # --- 使用者管理 ---
     
     def get_user(self, line_id: str):
@@ -25,35 +185,76 @@ class Database:
         return None
 
     def upsert_user(self, profile):
-        """使用者第一次互動時建立資料，或更新基本資料"""
+        """
+        使用者第一次互動時建立資料，或更新基本資料
+        已知使用者只做一次 merge 寫入 (不先讀取)，此時僅回傳基本欄位
+        """
         user_ref = db.collection('users').document(profile.user_id)
+
+        known_name = self._known_users.get(profile.user_id)
+        if known_name is not None:
+            # 舊使用者，僅更新 LINE 暱稱 (不蓋掉社團暱稱)
+            user_ref.set({
+                "line_id": profile.user_id,
+                "display_name": profile.display_name
+            }, merge=True)
+            self._remember_user(profile.user_id, profile.display_name)
+            if known_name != profile.display_name:
+                self._rebuild_members_aggregate()
+            return {"line_id": profile.user_id, "display_name": profile.display_name}
+
         doc = user_ref.get()
         
         if not doc.exists:
             # 新使用者，預設排序為目前最大值 + 1
-            max_order = self._get_max_sort_order()
             new_user = User(
                 line_id=profile.user_id,
                 display_name=profile.display_name,
-                sort_order=max_order + 1
+                sort_order=self._reserve_next_sort_order()
             )
             user_ref.set(new_user.model_dump())
+            self._remember_user(profile.user_id, profile.display_name)
+            self._rebuild_members_aggregate()
             return new_user.model_dump()
         else:
             # 舊使用者，僅更新 LINE 暱稱 (不蓋掉社團暱稱)
             user_ref.update({"display_name": profile.display_name})
-            return doc.to_dict()
+            self._remember_user(profile.user_id, profile.display_name)
+            data = doc.to_dict()
+            if data.get('display_name') != profile.display_name:
+                self._rebuild_members_aggregate()
+            return data
+
+    def _remember_user(self, line_id: str, display_name: str):
+        """記錄已存在的使用者，超過上限時淘汰最久未互動者"""
+        self._known_users[line_id] = display_name
+        self._known_users.move_to_end(line_id)
+        if len(self._known_users) > KNOWN_USERS_MAX:
+            self._known_users.popitem(last=False)
+
+    def _reserve_next_sort_order(self):
+        """
+        以交易遞增 aggregates/counters 的 max_sort_order，回傳新使用者的排序值
+        管理員手動調整的排序可能超過計數器，因此同時參考成員列表中的最大值
+        (計數器不存在時也等於由成員列表初始化)
+        """
+        counter_ref = db.collection('aggregates').document('counters')
+        members_max = max((m.get('sort_order') or 0 for m in self.get_all_members()), default=0)
 
-    def _get_max_sort_order(self):
-        """取得目前最大的排序值"""
-        users = db.collection('users').order_by('sort_order', direction=firestore.Query.DESCENDING).limit(1).stream()
-        for user in users:
-            return user.to_dict().get('sort_order', 999)
-        return 0
+        @firestore.transactional
+        def reserve(transaction):
+            snap = counter_ref.get(transaction=transaction)
+            current = snap.to_dict().get('max_sort_order', 0) if snap.exists else 0
+            next_order = max(current, members_max) + 1
+            transaction.set(counter_ref, {"max_sort_order": next_order}, merge=True)
+            return next_order
+
+        return reserve(db.transaction())
 
     def verify_admin_code(self, line_id: str, code: str):
         """驗證啟動碼並升級為管理員"""
         if code == config.ADMIN_SETUP_CODE:
+            # is_admin 不在成員彙總內，不需重建
             db.collection('users').document(line_id).update({"is_admin": True})
             return True
         return False
@@ -63,19 +264,42 @@ class Database:
         # 這裡未來可以加入邏輯：如果數字重複，是否自動將其他人往後移
         # 目前先實作最簡單的更新
         db.collection('users').document(line_id).update({"sort_order": new_order})
+        self._rebuild_members_aggregate()
 
     # --- 成員管理 (新增：供 Admin LIFF 使用) ---
     
     def get_all_members(self):
         """取得所有成員 (用於管理列表)"""
-        # 依照 sort_order 排序
-        docs = db.collection('users').order_by('sort_order').stream()
-        return [doc.to_dict() for doc in docs]
+        # 彙總文件內已依照 sort_order 排序
+        return self._get_members_aggregate()['members']
 
     def update_member_status(self, user_id: str, updates: dict):
         """更新成員資料 (排序、狀態、暱稱)"""
         # updates 範例: {"sort_order": 5, "status": "LEAVE", "club_name": "社長"}
         db.collection('users').document(user_id).update(updates)
+        if self._touches_members(updates):
+            self._rebuild_members_aggregate()
+
+    def bulk_update_members(self, updates: dict):
+        """
+        批次更新多位成員 (例如整份排序列表一次送出)
+        updates 範例: {"U123": {"sort_order": 1}, "U456": {"sort_order": 2, "status": "LEAVE"}}
+        """
+        if not updates:
+            return
+        try:
+            batch = db.batch()
+            for i, (user_id, patch) in enumerate(updates.items()):
+                batch.update(db.collection('users').document(user_id), patch)
+                if (i + 1) % BATCH_LIMIT == 0:
+                    batch.commit()
+                    batch = db.batch()
+            batch.commit()
+        finally:
+            # 全部寫完後只重建一次彙總文件
+            # 中途失敗時前面的批次可能已寫入，仍需重建
+            if any(self._touches_members(patch) for patch in updates.values()):
+                self._rebuild_members_aggregate()
 
     # --- 活動管理 ---
 
@@ -96,14 +320,39 @@ class Database:
         doc = db.collection('events').document(event_id).get()
         return doc.to_dict() if doc.exists else None
     
-    def get_draft_events(self):
-        """取得所有草稿 (供 Admin 列表選擇編輯)"""
-        docs = db.collection('events')\
+    def get_draft_events(self, limit: int = 50, start_after: str = None):
+        """
+        取得草稿 (供 Admin 列表選擇編輯)，依日期分頁
+        start_after 為上一頁最後一筆的活動 ID (不存在時拋出 InvalidCursorError)，回傳 (events, next_cursor)
+        next_cursor 為 None 代表已經沒有下一頁
+        索引定義於 firestore.indexes.json
+        """
+        query = db.collection('events')\
             .where('status', '==', EventStatus.DRAFT.value)\
             .order_by('event_date')\
+            .limit(limit)
+        if start_after:
+            cursor_doc = db.collection('events').document(start_after).get()
+            if not cursor_doc.exists:
+                # 找不到游標時不可默默回到第一頁，否則逐頁讀取的 client 會無限循環
+                raise InvalidCursorError(f"Unknown cursor: {start_after}")
+            query = query.start_after(cursor_doc)
+
+        docs = [doc.to_dict() for doc in query.get()]
+        next_cursor = docs[-1]['id'] if len(docs) == limit else None
+        return docs, next_cursor
+    
+    def get_published_events(self):
+        """取得今天 (含) 以後已發佈的活動 (供 Admin 列表)"""
+        today_str = datetime.now().strftime("%Y-%m-%d")
+        docs = db.collection('events')\
+            .where('status', '==', EventStatus.PUBLISHED.value)\
+            .where('event_date', '>=', today_str)\
+            .order_by('event_date')\
+            .order_by('event_time')\
             .stream()
         return [doc.to_dict() for doc in docs]
-    
+
     def get_next_draft_event(self):
         """
         取得「下一個」DRAFT 活動 (用於發佈)
@@ -116,7 +365,7 @@ class Database:
             .where('event_date', '>=', today_str)\
             .order_by('event_date')\
             .order_by('event_time')\
-            .limit(1).stream()
+            .limit(1).get()
         
         for doc in docs:
             return doc.to_dict()
@@ -124,40 +373,95 @@ class Database:
 
     # --- 報名與統計邏輯 (核心) ---
 
+    @staticmethod
+    def _fill_attendance_totals(attendance: Attendance):
+        """寫入前預先計算大人/小孩/來賓總數，統計時不必再逐一加總"""
+        attendance.total_adults = attendance.family_adults + sum(g.adults for g in attendance.guests)
+        attendance.total_kids = attendance.family_kids + sum(g.kids for g in attendance.guests)
+        attendance.guest_count = len(attendance.guests)
+        return attendance
+
+    @staticmethod
+    def _legacy_attendance_totals(att: dict):
+        """舊版報名紀錄 (沒有預先計算的人數) 在讀取時補算，規則同 _fill_attendance_totals"""
+        guests = att.get('guests', [])
+        return {
+            **att,
+            "total_adults": att.get('family_adults', 0) + sum(g.get('adults', 1) for g in guests),
+            "total_kids": att.get('family_kids', 0) + sum(g.get('kids', 0) for g in guests),
+            "guest_count": len(guests)
+        }
+
     def add_attendance(self, event_id: str, attendance: Attendance):
         """寫入報名資料"""
+        self._fill_attendance_totals(attendance)
         db.collection('events').document(event_id)\
             .collection('participants').document(attendance.user_id)\
             .set(attendance.model_dump())
+        self._event_version[event_id] = self._event_version.get(event_id, 0) + 1
+
+    def bulk_add_attendance(self, event_id: str, attendances: list):
+        """批次寫入多筆報名資料 (例如匯入來賓)"""
+        participants = db.collection('events').document(event_id).collection('participants')
+        try:
+            batch = db.batch()
+            for i, attendance in enumerate(attendances):
+                self._fill_attendance_totals(attendance)
+                batch.set(participants.document(attendance.user_id), attendance.model_dump())
+                if (i + 1) % BATCH_LIMIT == 0:
+                    batch.commit()
+                    batch = db.batch()
+            batch.commit()
+        finally:
+            # 中途失敗時前面的批次可能已寫入，仍需讓統計快取失效
+            self._event_version[event_id] = self._event_version.get(event_id, 0) + 1
 
     def get_participant(self, event_id: str, user_id: str):
         doc = db.collection('events').document(event_id)\
             .collection('participants').document(user_id).get()
         return doc.to_dict() if doc.exists else None
 
+    def get_event_counts(self, event_id: str):
+        """
+        取得活動報名人數 (只計數，不傳回名單)
+        使用 Firestore count() 聚合查詢，伺服器只回傳數字
+        注意：這是報名紀錄的原始數量，未套用 get_event_statistics 的分類規則
+        (例如請假成員按 -1 在這裡會算進 not_going)
+        """
+        participants = db.collection('events').document(event_id).collection('participants')
+
+        def count(status):
+            result = participants.where('status', '==', status.value).count().get()
+            return result[0][0].value
+
+        f_going = _pool.submit(count, ParticipantStatus.GOING)
+        f_not_going = _pool.submit(count, ParticipantStatus.NOT_GOING)
+        return {"going": f_going.result(), "not_going": f_not_going.result()}
+
     def get_event_statistics(self, event_id: str):
         """
         取得活動統計資料 (包含未回覆的計算)
         依照定案的優先順序邏輯處理
+        結果會快取 STATS_CACHE_TTL 秒，報名或成員異動時失效
         """
+        version = self._event_version.get(event_id, 0)
+        cached = self._stats_cache.get(event_id)
+        if cached and cached[0] == version and time.monotonic() - cached[1] < STATS_CACHE_TTL:
+            return cached[2]
+
+        # 成員與報名紀錄兩個查詢互不相依，平行發出
+        f_members = _pool.submit(self._get_members_aggregate)
+        f_parts = _pool.submit(
+            db.collection('events').document(event_id)
+            .collection('participants').select(STATS_PARTICIPANT_FIELDS).get
+        )
+
         # 1. 取得所有「在籍」與「請假」的成員 (排除 INACTIVE)
-        all_users_stream = db.collection('users')\
-            .where('status', 'in', [UserStatus.ACTIVE, UserStatus.LEAVE])\
-            .order_by('sort_order').stream()
-        
-        # 轉為 Dict 方便查詢，並保留排序
-        users_map = {} # {uid: user_data}
-        sorted_uids = []
-        for u in all_users_stream:
-            data = u.to_dict()
-            users_map[data['line_id']] = data
-            sorted_uids.append(data['line_id'])
+        # 名單來自彙總文件 (已依 sort_order 排序，顯示名稱已預先算好)
+        roster = f_members.result()['roster']
 
         # 2. 取得該活動的所有報名紀錄
-        participants_stream = db.collection('events').document(event_id)\
-            .collection('participants').stream()
-        
-        attendance_map = {p.id: p.to_dict() for p in participants_stream}
+        attendance_map = {p.id: p.to_dict() for p in f_parts.result()}
 
         # 3. 分類容器
         stats = {
@@ -167,52 +471,30 @@ class Database:
             "no_response": []  # 尚未回覆
         }
 
-        # 4. 執行分類邏輯 (依照定案規則)
-        for uid in sorted_uids:
-            user = users_map[uid]
-            att = attendance_map.get(uid) # 可能為 None
-            
-            # 顯示名稱邏輯：優先用社團暱稱
-            display_name = user.get('club_name') or user.get('display_name')
-
-            # 判斷變數
-            u_status = user.get('status')
-            e_status = att.get('status') if att else None
-
-            # --- 邏輯開始 ---
-
-            # Rule 1: 確定出席 (不管身分，只要報名 +1 就算)
-            if e_status == ParticipantStatus.GOING:
-                # 檢查是否有攜伴
-                guests = att.get('guests', [])
-                total_guests_adults = sum(g.get('adults', 1) for g in guests)
-                total_guests_kids = sum(g.get('kids', 0) for g in guests)
-                family_adults = att.get('family_adults', 0)
-                family_kids = att.get('family_kids', 0)
-                guest_count = len(guests)
+        # 4. 執行分類邏輯 (依照定案規則，見 _RULE_MATRIX)
+        # 報名狀態先轉成編碼 (每筆報名只做一次)，迴圈內只剩兩次 list 索引
+        e_codes = {
+            uid: _PARTICIPANT_CODES.get(att.get('status'), PARTICIPANT_NONE)
+            for uid, att in attendance_map.items()
+        }
+        for uid, display_name, u_code in zip(roster['line_ids'], roster['names'], roster['status_codes']):
+            category = _RULE_MATRIX[u_code][e_codes.get(uid, PARTICIPANT_NONE)]
+            if category == "going":
+                # 人數於寫入時已預先計算 (見 _fill_attendance_totals)
+                att = attendance_map[uid]
+                if 'guest_count' not in att:
+                    att = self._legacy_attendance_totals(att)
                 stats["going"].append({
                     "name": display_name,
-                    "guests": guest_count,
-                    "guest_details": guests
+                    "guests": att.get('guest_count', 0),
+                    "guest_details": att.get('guests', []),
+                    "total_adults": att.get('total_adults', 0),
+                    "total_kids": att.get('total_kids', 0)
                 })
-            
-            # Rule 2: 長期請假 (身分為 LEAVE 且 沒報名出席)
-            # 注意：即使他在 Flex 按 -1，依然歸類在此，不算 "不克出席"
-            elif u_status == UserStatus.LEAVE:
-                stats["leave"].append({"name": display_name})
-
-            # Rule 3: 不克出席 (身分 ACTIVE 且 報名 -1)
-            elif u_status == UserStatus.ACTIVE and e_status == ParticipantStatus.NOT_GOING:
-                stats["not_going"].append({"name": display_name})
-
-            # Rule 4: 尚未回覆 (身分 ACTIVE 且 無紀錄)
-            elif u_status == UserStatus.ACTIVE and e_status is None:
-                stats["no_response"].append({"name": display_name})
-            
-            # Rule 5: 例外處理 (如身分 ACTIVE 但資料庫有奇怪的狀態)，歸入未回覆
-            elif u_status == UserStatus.ACTIVE:
-                stats["no_response"].append({"name": display_name})
+            else:
+                stats[category].append({"name": display_name})
 
+        self._stats_cache[event_id] = (version, time.monotonic(), stats)
         return stats
 
 db_service = Database()
\ No newline at end of file
@@ -1,21 +1,44 @@
 import os
 import sys
-import requests
-from fastapi import FastAPI, Request, HTTPException, Depends, Header
-from typing import Optional
+import time
+import hashlib
+import hmac
+import base64
+import asyncio
+import httpx
+import orjson
+from fastapi import FastAPI, Request, HTTPException, Depends, Header, Query
+from fastapi.concurrency import run_in_threadpool
+from typing import Optional, Dict
 from pydantic import BaseModel
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage, PostbackEvent
+from linebot import LineBotApi
+from linebot.models import MessageEvent, TextSendMessage, PostbackEvent
 from config import config
-from database import db_service
+from database import db_service, InvalidCursorError
 from models import User, Event, EventStatus 
 
 app = FastAPI()
 
 # LINE Bot 初始化
 line_bot_api = LineBotApi(config.LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(config.LINE_CHANNEL_SECRET)
+# Webhook 簽章驗證用的 Channel Secret (SDK 只用於發送訊息)
+# 未設定時直接啟動失敗，絕不可退回空字串 (任何人都能用空金鑰偽造簽章)
+if not config.LINE_CHANNEL_SECRET:
+    raise RuntimeError("LINE_CHANNEL_SECRET 未設定，無法驗證 Webhook 簽章")
+channel_secret = config.LINE_CHANNEL_SECRET.encode('utf-8')
+
+# 共用的 HTTP 連線 (keep-alive)，避免每次驗證 Token 都重新建立 TLS 連線
+http_client = httpx.AsyncClient(timeout=5.0, limits=httpx.Limits(max_keepalive_connections=20))
+
+# 已驗證的管理員快取 {sha256(token): (expires_at, db_user)}
+# 命中時同時省下 LINE Verify API 與 Firestore get_user
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_MAX = 2048
+_token_cache = {}
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
 
 @app.get("/")
 def health_check():
@@ -26,15 +49,27 @@ def health_check():
 async def callback(request: Request):
     signature = request.headers.get('X-Line-Signature', '')
     body = await request.body()
-    body_str = body.decode('utf-8')
 
-    try:
-        handler.handle(body_str, signature)
-    except InvalidSignatureError:
+    # 直接對原始 bytes 驗證簽章，不先 decode
+    if not verify_signature(body, signature):
         raise HTTPException(status_code=400, detail="Invalid signature")
+
+    # 處理函式會呼叫 LINE API 與 Firestore (皆為同步 I/O)，移到 threadpool 避免卡住 event loop
+    payload = orjson.loads(body)
+    for event in payload.get('events', []):
+        await run_in_threadpool(dispatch_event, event)
     
     return "OK"
 
+def verify_signature(body: bytes, signature: str) -> bool:
+    """驗證 X-Line-Signature：Base64(HMAC-SHA256(channel secret, body))"""
+    try:
+        expected = base64.b64decode(signature, validate=True)
+    except ValueError:
+        return False
+    digest = hmac.new(channel_secret, body, hashlib.sha256).digest()
+    return hmac.compare_digest(digest, expected)
+
 # --- 1. 安全性驗證 (Dependency) ---
 
 async def verify_admin_token(authorization: Optional[str] = Header(None)):
@@ -48,9 +83,15 @@ async def verify_admin_token(authorization: Optional[str] = Header(None)):
     
     token = authorization.replace("Bearer ", "")
     
+    # 同一個 Token 在 TOKEN_CACHE_TTL 秒內 (且未過期) 直接使用快取
+    token_key = hashlib.sha256(token.encode()).digest()
+    cached = _token_cache.get(token_key)
+    if cached and time.time() < cached[0]:
+        return cached[1]
+
     # 呼叫 LINE Verify API
     verify_url = "https://api.line.me/oauth2/v2.1/verify"
-    response = requests.post(verify_url, data={
+    response = await http_client.post(verify_url, data={
         "id_token": token,
         "client_id": config.LIFF_ID_ADMIN  # 需在 .env 設定管理員 LIFF ID
     })
@@ -62,9 +103,17 @@ async def verify_admin_token(authorization: Optional[str] = Header(None)):
     line_uid = user_data.get('sub')
     
     # 檢查是否為系統管理員
-    db_user = db_service.get_user(line_uid)
+    db_user = await run_in_threadpool(db_service.get_user, line_uid)
     if not db_user or not db_user.get('is_admin'):
         raise HTTPException(status_code=403, detail="Permission Denied: Not Admin")
+
+    # 快取時間不超過 Token 本身的到期時間 (exp)
+    now = time.time()
+    expires_at = min(now + TOKEN_CACHE_TTL, user_data.get('exp', now))
+    if len(_token_cache) >= TOKEN_CACHE_MAX:
+        # 淘汰最早放入的一筆
+        _token_cache.pop(next(iter(_token_cache)))
+    _token_cache[token_key] = (expires_at, db_user)
     
     return db_user # 回傳使用者資料供 API 使用
 
@@ -72,10 +121,17 @@ async def verify_admin_token(authorization: Optional[str] = Header(None)):
 
 # 取得活動列表 (包含草稿與已發佈，供管理)
 @app.get("/api/admin/events")
-def list_events(user = Depends(verify_admin_token)):
-    # 這裡簡單實作：回傳草稿 + 未來已發佈的活動
-    drafts = db_service.get_draft_events()
-    return {"events": drafts}
+async def list_events(limit: int = Query(50, ge=1, le=100), cursor: Optional[str] = None, user = Depends(verify_admin_token)):
+    # 回傳草稿 + 未來已發佈的活動，兩個查詢在 threadpool 中平行執行
+    # 草稿依日期分頁，下一頁帶入回傳的 next_cursor
+    try:
+        (drafts, next_cursor), published = await asyncio.gather(
+            run_in_threadpool(db_service.get_draft_events, limit=limit, start_after=cursor),
+            run_in_threadpool(db_service.get_published_events)
+        )
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"events": drafts, "published": published, "next_cursor": next_cursor}
 
 # 建立活動
 @app.post("/api/admin/events")
@@ -89,10 +145,16 @@ def create_event_api(event: Event, user = Depends(verify_admin_token)):
 @app.put("/api/admin/events/{event_id}")
 def update_event_api(event_id: str, event: Event, user = Depends(verify_admin_token)):
     # 排除 None 的欄位，避免覆蓋掉原本的資料 (視需求而定)
-    update_data = {k: v for k, v in event.model_dump().items() if v is not None}
+    # 只送出有帶值的欄位 (未傳入的預設值如 status / created_at_ms 也不會覆蓋)
+    update_data = event.model_dump(exclude_none=True, exclude_unset=True)
     db_service.update_event(event_id, update_data)
     return {"status": "success"}
 
+# 取得活動報名人數 (只需數字時使用，不傳回名單)
+@app.get("/api/admin/events/{event_id}/counts")
+def event_counts_api(event_id: str, user = Depends(verify_admin_token)):
+    return db_service.get_event_counts(event_id)
+
 # 取得成員列表 (供排序與管理)
 @app.get("/api/admin/members")
 def list_members(user = Depends(verify_admin_token)):
@@ -106,15 +168,38 @@ class MemberUpdateReq(BaseModel):
     club_name: Optional[str] = None
     is_admin: Optional[bool] = None
 
+def _pack_member_update(req: MemberUpdateReq) -> dict:
+    """只取出有帶值的欄位 (由 pydantic-core 一次序列化完成)"""
+    return req.model_dump(exclude_none=True, exclude_unset=True)
+
 @app.put("/api/admin/members/{user_id}")
 def update_member_api(user_id: str, req: MemberUpdateReq, user = Depends(verify_admin_token)):
-    update_data = {k: v for k, v in req.model_dump().items() if v is not None}
-    db_service.update_member_status(user_id, update_data)
+    update_data = _pack_member_update(req)
+    if update_data:
+        db_service.update_member_status(user_id, update_data)
     return {"status": "success"}
 
+# 批次更新成員資料 (整份排序列表一次送出)
+@app.post("/api/admin/members/bulk")
+def bulk_update_members_api(req: Dict[str, MemberUpdateReq], user = Depends(verify_admin_token)):
+    updates = {}
+    for user_id, member in req.items():
+        update_data = _pack_member_update(member)
+        if update_data:
+            updates[user_id] = update_data
+    db_service.bulk_update_members(updates)
+    return {"status": "success", "updated": len(updates)}
+
 # --- 事件處理邏輯 ---
 
-@handler.add(MessageEvent, message=TextMessage)
+def dispatch_event(event: dict):
+    """依事件類型轉成 SDK 的事件物件，交給對應的處理函式 (其他類型忽略)"""
+    event_type = event.get('type')
+    if event_type == 'message' and event.get('message', {}).get('type') == 'text':
+        handle_message(MessageEvent.new_from_json_dict(event))
+    elif event_type == 'postback':
+        handle_postback(PostbackEvent.new_from_json_dict(event))
+
 def handle_message(event):
     msg = event.message.text.strip()
     user_id = event.source.user_id
@@ -145,7 +230,6 @@ def handle_message(event):
     if event.source.type == "group":
         return
 
-@handler.add(PostbackEvent)
 def handle_postback(event):
     data = event.postback.data
     user_id = event.source.user_id
@@ -1,7 +1,7 @@
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from enum import Enum
-from datetime import datetime
+import time
 
 # --- Enums 保持不變 ---
 class UserStatus(str, Enum):
@@ -19,6 +19,10 @@ class ParticipantStatus(str, Enum):
     GOING = "GOING"
     NOT_GOING = "NOT_GOING"
 
+def now_ms() -> int:
+    """目前時間 (epoch 毫秒)，寫入 Firestore 比 datetime 更小也更好比較"""
+    return int(time.time() * 1000)
+
 # --- Models ---
 
 class Guest(BaseModel):
@@ -49,7 +53,7 @@ class Event(BaseModel):
     description: Optional[str] = None # 備註 (對應 note)
     
     status: EventStatus = EventStatus.DRAFT
-    created_at: datetime = datetime.now()
+    created_at_ms: int = Field(default_factory=now_ms)
 
 class Attendance(BaseModel):
     user_id: str
@@ -58,4 +62,8 @@ class Attendance(BaseModel):
     family_adults: int = 0
     family_kids: int = 0
     guests: List[Guest] = []
-    updated_at: datetime = datetime.now()
\ No newline at end of file
+    # 寫入時預先算好的總數 (含本人家屬與來賓)，統計時直接讀取
+    total_adults: int = 0
+    total_kids: int = 0
+    guest_count: int = 0
+    updated_at_ms: int = Field(default_factory=now_ms)
\ No newline at end of file